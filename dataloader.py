@@ -1,4 +1,4 @@
-import os, random, pickle
+import os, random, pickle, torch
 from os.path import join, isfile
 from tqdm import tqdm
 import numpy as np
@@ -230,6 +230,12 @@ def dataloader(dset, path, bs, num_workers, num_labels, num_iters, return_unlabe
         assert dset == "cifar100" and num_labels == 50000, 'Use additional data only for cifar100 dataset with 50k labeled data'
         train_kwargs[dset]["additional"] = additional
     
+    # Keep workers alive across epochs (the test loader is re-iterated at every test) and stage batches ahead
+    num_workers = min(num_workers, os.cpu_count() or 1)
+    loader_kwargs = {'num_workers': num_workers, 'pin_memory': True}
+    if num_workers > 0:
+        loader_kwargs.update(persistent_workers=True, prefetch_factor=4)
+    
     train_dataset = train_dset[dset](
             root = path,
             num_labels = num_labels,
@@ -240,17 +246,53 @@ def dataloader(dset, path, bs, num_workers, num_labels, num_iters, return_unlabe
             save_path = save_path,
             **train_kwargs[dset]
             )
-    train_loader = DataLoader(train_dataset, batch_size=bs, num_workers=num_workers, shuffle=False)
+    train_loader = DataLoader(train_dataset, batch_size=bs, shuffle=False, **loader_kwargs)
     
     test_transform = transforms.Compose([
             transforms.ToTensor(),
             transforms.Normalize(*meanstd[dset])
             ])
     test_dataset = test_dset[dset](root=path, transform=test_transform, **test_kwargs[dset])
-    test_loader = DataLoader(test_dataset, batch_size=100, num_workers=num_workers, shuffle=False)
+    test_loader = DataLoader(test_dataset, batch_size=100, shuffle=False, **loader_kwargs)
     
     return iter(train_loader), test_loader
 
+class CUDAPrefetcher():
+    """ Copy the next batch to GPU on a side stream while the current one is consumed """
+    def __init__(self, loader, memory_format=torch.contiguous_format):
+        self.loader = iter(loader)
+        self.memory_format = memory_format
+        self.stream = torch.cuda.Stream()
+        self.preload()
+
+    def preload(self):
+        try:
+            batch = next(self.loader)
+        except StopIteration:
+            self.batch = None
+            return
+        with torch.cuda.stream(self.stream):
+            batch = [t.cuda(non_blocking=True) for t in batch]
+            # Only image batches have a memory format to convert
+            self.batch = [t.contiguous(memory_format=self.memory_format) if t.dim() == 4 else t for t in batch]
+
+    def next(self):
+        if self.batch is None:
+            raise StopIteration
+        torch.cuda.current_stream().wait_stream(self.stream)
+        batch = self.batch
+        # Tensors were allocated on the side stream but are consumed on the current one
+        for t in batch:
+            t.record_stream(torch.cuda.current_stream())
+        self.preload()
+        return batch
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.next()
+
 """
 class TinyImages(Dataset):
     ''' Tiny Images Dataset '''
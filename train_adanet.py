@@ -2,12 +2,10 @@ import os, argparse, torch, time
 from itertools import chain
 import torch.nn.functional as F
 from torch.optim import SGD
-from torch.optim.lr_scheduler import MultiStepLR
 from torch.distributions import Beta
-from tensorboardX import SummaryWriter
 
 from dataloader import cifar10
-from utils import make_folder, AverageMeter, Logger, accuracy, save_checkpoint
+from utils import make_folder, AverageMeter, AsyncSummaryWriter, Logger, accuracy, save_checkpoint
 from model import ConvLarge, Classifier, Discriminator
 
 parser = argparse.ArgumentParser()
@@ -40,11 +38,14 @@ args = parser.parse_args()
 # Create directories if not exist
 make_folder(args.save_path)
 logger = Logger(os.path.join(args.save_path, 'log.txt'))
-writer = SummaryWriter(log_dir=args.save_path)
+writer = AsyncSummaryWriter(log_dir=args.save_path)
 logger.info('Called with args:')
 logger.info(args)
 
 torch.backends.cudnn.benchmark = True
+# Allow TF32 Tensor Cores for conv and matmul on Ampere and newer GPUs
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
 
 # Define dataloader
 logger.info("Loading data...")
@@ -58,12 +59,11 @@ model = ConvLarge().cuda()
 classifier = Classifier().cuda()
 discriminator = Discriminator().cuda()
 
-# Build optimizer and lr_scheduler
-logger.info("Building optimizer and lr_scheduler...")
+# Build optimizer and learning rate milestones
+logger.info("Building optimizer and learning rate milestones...")
 optimizer = SGD(chain(model.parameters(), classifier.parameters(), discriminator.parameters()),
                 lr=args.lr, momentum=args.momentum, weight_decay=args.weight_decay)
-lr_scheduler = MultiStepLR(optimizer, gamma=args.lr_decay,
-                           milestones=[args.total_steps//2, args.total_steps*3//4])
+lr_milestones = [args.total_steps//2, args.total_steps*3//4]
    
 # Build Beta distribution
 logger.info("Building Beta distribution...")
@@ -87,6 +87,7 @@ if args.resume is not None:
 def main():
     data_times, batch_times, losses, label_acc, unlabel_acc = [AverageMeter() for _ in range(5)]
     best_acc = 0.
+    lr = optimizer.param_groups[0]['lr']
     logger.info("Start training...")
     for step in range(args.start_step, args.total_steps):
         # Load data and distribute to devices
@@ -135,7 +136,11 @@ def main():
         optimizer.zero_grad()
         total_loss.backward()
         optimizer.step()
-        lr_scheduler.step()
+        # Anneal learning rate at milestones
+        if step + 1 in lr_milestones:
+            lr *= args.lr_decay
+            for param_group in optimizer.param_groups:
+                param_group['lr'] = lr
 
         # Compute accuracy for labeled data and unlabeled data
         label_top1, = accuracy(label_pred, label_gt, topk=(1,))
@@ -154,7 +159,7 @@ def main():
         writer.add_scalar('train/total-loss', total_loss.item(), step)
         writer.add_scalar('train/cls-loss', cls_loss.item(), step)
         writer.add_scalar('train/dis-loss', dis_loss.item(), step)
-        writer.add_scalar('train/lr', optimizer.param_groups[0]['lr'], step)
+        writer.add_scalar('train/lr', lr, step)
     
         # Print and log
         if step % args.print_freq == 0:
@@ -162,7 +167,7 @@ def main():
                         "Btime: {btimes.val:.3f} (avg {btimes.avg:.3f}) loss: {losses.val:.3f} "
                         "(avg {losses.avg:.3f}) label-acc: {label.val:.3f} (avg {label.avg:.3f}) "
                         "unlabel-acc: {unlabel.val:.3f} (avg {unlabel.avg:.3f}) LR: {2:.4f}".format(
-                                step, args.total_steps, optimizer.param_groups[0]['lr'],
+                                step, args.total_steps, lr,
                                 dtimes=data_times, btimes=batch_times, losses=losses,
                                 label=label_acc, unlabel=unlabel_acc
                                 ))
@@ -1,12 +1,13 @@
-import os, argparse, torch, math, time, random
+import os, argparse, torch, math, time, random, copy
+from concurrent.futures import ThreadPoolExecutor
 from os.path import join, isfile
 import torch.nn.functional as F
 from torch.optim import SGD
+from torch.cuda.amp import autocast, GradScaler
 from torch.distributions import Beta
-from tensorboardX import SummaryWriter
 
-from dataloader import dataloader
-from utils import make_folder, AverageMeter, Logger, accuracy, save_checkpoint
+from dataloader import dataloader, CUDAPrefetcher
+from utils import make_folder, AverageMeter, GPUMeter, AsyncSummaryWriter, Logger, accuracy, loss_and_accuracy, fuse_conv_bn, save_checkpoint, copy_best_checkpoint
 from model import ConvLarge, shakeshake26, wideresnet28
 
 parser = argparse.ArgumentParser()
@@ -30,6 +31,10 @@ parser.add_argument('--milestones', type=eval, default=[300000, 350000], help='L
 parser.add_argument('--weight-decay', type=float, default=1e-4, help='Weight decay')
 parser.add_argument('--momentum', type=float, default=0.9, help='Momentum for SGD optimizer')
 parser.add_argument('--num-workers', type=int, default=4, help='Number of workers')
+parser.add_argument('--compile', action='store_true', help='Compile the model with torch.compile')
+parser.add_argument('--amp', action='store_true', help='Use automatic mixed precision (fp16) training')
+parser.add_argument('--channels-last', action='store_true', help='Use channels_last (NHWC) memory format')
+parser.add_argument('--cuda-graph', action='store_true', help='Capture forward and backward of the model as CUDA graphs')
 parser.add_argument('--resume', type=str, default=None, help='Resume model from a checkpoint')
 parser.add_argument('--seed', type=int, default=1234, help='Random seed for reproducibility')
 parser.add_argument('--print-freq', type=int, default=100, help='Print and log frequency')
@@ -37,6 +42,7 @@ parser.add_argument('--test-freq', type=int, default=400, help='Test frequency')
 parser.add_argument('--save-path', type=str, default='./results/tmp', help='Save path')
 args = parser.parse_args()
 args.num_classes = 100 if args.dataset == 'cifar100' else 10
+memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
 
 # Set random seed
 random.seed(args.seed)
@@ -49,12 +55,54 @@ torch.backends.cudnn.benchmark = False
 # Create directories if not exist
 make_folder(args.save_path)
 logger = Logger(join(args.save_path, 'log.txt'))
-writer = SummaryWriter(log_dir=args.save_path)
+writer = AsyncSummaryWriter(log_dir=args.save_path)
 logger.info('Called with args:')
 logger.info(args)
 torch.backends.cudnn.benchmark = True
+# Allow TF32 Tensor Cores for conv and matmul on Ampere and newer GPUs
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
 
-# Define dataloader
+# Build model and optimizer
+logger.info("Building model and optimizer...")
+if args.architecture == "convlarge":
+    model = ConvLarge(num_classes=args.num_classes, stochastic=True).cuda()
+elif args.architecture == "shakeshake":
+    model = shakeshake26(num_classes=args.num_classes).cuda()
+elif args.architecture == "wrn":
+    model = wideresnet28(num_classes=args.num_classes).cuda()
+model = model.to(memory_format=memory_format)
+# Frozen replica for testing, so that training goes on while it is evaluated on a side stream
+eval_model = copy.deepcopy(model)
+eval_stream = torch.cuda.Stream()
+eval_executor = ThreadPoolExecutor(max_workers=1)
+if args.compile:
+    # Fall back to eager mode for any op TorchInductor cannot handle
+    import torch._dynamo
+    torch._dynamo.config.suppress_errors = True
+    # Compile in place so that `state_dict()` keys stay compatible with eager checkpoints
+    # No CUDA graph trees: back-to-back eval mode calls (finite differences, pseudo-labeling)
+    # would overwrite the output buffers of earlier calls that are still read afterwards
+    model.compile(mode='max-autotune-no-cudagraphs', dynamic=False)
+    loss_and_accuracy = torch.compile(loss_and_accuracy)
+if args.cuda_graph:
+    assert not args.compile, "--cuda-graph captures the eager model and cannot be combined with --compile"
+    # Capture the training mode forward and backward on a fixed-shape batch. Eval mode calls run eagerly
+    bn_buffers = {name: buf.clone() for name, buf in model.named_buffers()}
+    sample_img = torch.randn(args.batch_size, 3, 32, 32, device='cuda').contiguous(memory_format=memory_format)
+    model.train()
+    with autocast(enabled=args.amp, cache_enabled=False):
+        model = torch.cuda.make_graphed_callables(model, (sample_img,))
+    # Warmup and capture ran on random data, restore BN statistics
+    with torch.no_grad():
+        for name, buf in model.named_buffers():
+            buf.copy_(bn_buffers[name])
+optimizer = SGD(model.parameters(), lr=args.lr, momentum=args.momentum, weight_decay=args.weight_decay, fused=True)
+scaler = GradScaler(enabled=args.amp)
+logger.info("Model:\n%s\nOptimizer:\n%s" % (str(model), str(optimizer)))
+
+# Define dataloader. Created after the CUDA graph capture: pin memory threads and
+# in-flight prefetch copies must not run while the capture is in progress
 logger.info("Loading data...")
 train_loader, test_loader = dataloader(
         dset = args.dataset,
@@ -66,17 +114,7 @@ train_loader, test_loader = dataloader(
         return_unlabel = args.mix_up,
         save_path = args.save_path
         )
-
-# Build model and optimizer
-logger.info("Building model and optimizer...")
-if args.architecture == "convlarge":
-    model = ConvLarge(num_classes=args.num_classes, stochastic=True).cuda()
-elif args.architecture == "shakeshake":
-    model = shakeshake26(num_classes=args.num_classes).cuda()
-elif args.architecture == "wrn":
-    model = wideresnet28(num_classes=args.num_classes).cuda()
-optimizer = SGD(model.parameters(), lr=args.lr, momentum=args.momentum, weight_decay=args.weight_decay)
-logger.info("Model:\n%s\nOptimizer:\n%s" % (str(model), str(optimizer)))
+train_prefetcher = CUDAPrefetcher(train_loader, memory_format)
 
 # Optionally build beta distribution
 if args.mix_up:
@@ -91,6 +129,9 @@ if args.resume is not None:
         best_acc = checkpoint['best_acc']
         model.load_state_dict(checkpoint['model'])
         optimizer.load_state_dict(checkpoint['optimizer'])
+        # A disabled scaler saves an empty state
+        if checkpoint.get('scaler'):
+            scaler.load_state_dict(checkpoint['scaler'])
         logger.info("=> loaded checkpoint '{}' (step {})".format(args.resume, checkpoint['step']))
     else:
         logger.info("=> no checkpoint found at '{}'".format(args.resume))
@@ -111,125 +152,165 @@ def compute_lr(step):
         lr = args.lr * ( 1. + math.cos( (step-args.warmup-args.const_steps) / (args.total_steps-args.warmup-args.const_steps) *  math.pi ) ) / 2.
     return lr
 
+# Learning rate of every step, computed once
+lr_table = [compute_lr(step) for step in range(args.total_steps)]
+
 def main():
     data_times, batch_times, losses, acc = [AverageMeter() for _ in range(4)]
     if args.mix_up:
         unlabel_acc = AverageMeter()
+    # Per-step loss and accuracies stay on device and are copied to host once per flush
+    stats_buf = torch.zeros(args.print_freq, 3 if args.mix_up else 2, device='cuda')
+    last_flushed = args.start_step - 1
     best_acc = 0.
+    eval_job = None
+    lr = None
     model.train()
     logger.info("Start training...")
     for step in range(args.start_step, args.total_steps):
         # Load data and distribute to devices
         data_start = time.time()
         if args.mix_up:
-            label_img, label_gt, unlabel_img, unlabel_gt = next(train_loader)
-        else:
-            label_img, label_gt = next(train_loader)
-        
-        label_img = label_img.cuda()
-        label_gt = label_gt.cuda()
-        if args.mix_up:
-            unlabel_img = unlabel_img.cuda()
-            unlabel_gt = unlabel_gt.cuda()
+            label_img, label_gt, unlabel_img, unlabel_gt = train_prefetcher.next()
             _label_gt = F.one_hot(label_gt, num_classes=args.num_classes).float()
+        else:
+            label_img, label_gt = train_prefetcher.next()
         data_end = time.time()
 
-        # Compute learning rate
-        lr = compute_lr(step)
-        for param_group in optimizer.param_groups:
-            param_group['lr'] = lr
+        # Update learning rate, the optimizer is only touched when it changes
+        if lr_table[step] != lr:
+            lr = lr_table[step]
+            for param_group in optimizer.param_groups:
+                param_group['lr'] = lr
 
         if args.mix_up:
             # Adopt mix-up augmentation
             model.eval()
-            with torch.no_grad():
-                label_pred = model(label_img)
-                unlabel_pred = F.softmax(model(unlabel_img), dim=1) 
+            with torch.no_grad(), autocast(enabled=args.amp):
+                # Batching both is exact, as BN uses running stats in eval mode
+                label_pred, unlabel_pred = model(torch.cat((label_img, unlabel_img))).split(label_img.size(0))
+                unlabel_pred = F.softmax(unlabel_pred, dim=1)
                 alpha = beta_distribution.sample((args.batch_size,)).cuda()
                 _alpha = alpha.view(-1, 1, 1, 1)
                 interp_img = (label_img * _alpha + unlabel_img * (1. - _alpha)).detach()
                 interp_pseudo_gt = (_label_gt * alpha + unlabel_pred * (1. - alpha)).detach()
             model.train()
-            interp_pred = model(interp_img)
-            loss = F.kl_div(F.log_softmax(interp_pred, dim=1), interp_pseudo_gt, reduction='batchmean')
+            # Weight cast cache is disabled as required by CUDA graphs (and unused within one forward)
+            with autocast(enabled=args.amp, cache_enabled=False):
+                interp_pred = model(interp_img)
+                loss = F.kl_div(F.log_softmax(interp_pred, dim=1), interp_pseudo_gt, reduction='batchmean')
         else:
             # Regular label loss
-            label_pred = model(label_img)
-            loss = F.cross_entropy(label_pred, label_gt, reduction='mean')
+            with autocast(enabled=args.amp, cache_enabled=False):
+                label_pred = model(label_img)
+                loss, top1 = loss_and_accuracy(label_pred, label_gt)
         
         # One SGD step
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
 
-        # Compute accuracy
-        top1, = accuracy(label_pred, label_gt, topk=(1,))
+        # Compute accuracy (already done along with the loss without mix-up)
         if args.mix_up:
+            top1, = accuracy(label_pred, label_gt, topk=(1,))
             unlabel_top1, = accuracy(unlabel_pred, unlabel_gt, topk=(1,))
+        # Record loss and accuracies without syncing with the device
+        stats = [loss.detach(), top1, unlabel_top1] if args.mix_up else [loss.detach(), top1]
+        stats_buf[step % args.print_freq] = torch.cat([x.view(1) for x in stats])
         # Update AverageMeter stats
         data_times.update(data_end - data_start)
         batch_times.update(time.time() - data_end)
-        losses.update(loss.item(), label_img.size(0))
-        acc.update(top1.item(), label_img.size(0))
-        if args.mix_up:
-            unlabel_acc.update(unlabel_top1.item(), unlabel_img.size(0))
+        
+        # Flush buffered stats to AverageMeters and tfboard
+        is_test_step = (step + 1) % args.test_freq == 0 or step == args.total_steps - 1
+        if step % args.print_freq == 0 or is_test_step:
+            stats_host = stats_buf.tolist()
+            for s in range(last_flushed + 1, step + 1):
+                values = stats_host[s % args.print_freq]
+                losses.update(values[0], args.batch_size)
+                acc.update(values[1], args.batch_size)
+                writer.add_scalar('train/loss', values[0], s)
+                writer.add_scalar('train/label-acc', values[1], s)
+                if args.mix_up:
+                    unlabel_acc.update(values[2], args.batch_size)
+                    writer.add_scalar('train/unlabel-acc', values[2], s)
+                writer.add_scalar('train/lr', lr_table[s], s)
+            last_flushed = step
         
         # Print and log
         if step % args.print_freq == 0:
             logger.info("Step: [{0:05d}/{1:05d}] Dtime: {dtimes.avg:.3f} Btime: {btimes.avg:.3f} "
                         "loss: {losses.val:.3f} (avg {losses.avg:.3f}) Lacc: {label.val:.3f} (avg {label.avg:.3f}) "
-                        "LR: {2:.4f}".format(step, args.total_steps, optimizer.param_groups[0]['lr'],
+                        "LR: {2:.4f}".format(step, args.total_steps, lr,
                                              dtimes=data_times, btimes=batch_times, losses=losses, label=acc))
 
         # Test and save model
-        if (step + 1) % args.test_freq == 0 or step == args.total_steps - 1:
-            val_acc = evaluate(test_loader, model)
-            
-            # Remember best accuracy and save checkpoint
-            is_best = val_acc > best_acc
-            if is_best:
-                best_acc = val_acc
-            logger.info("Best Accuracy: %.5f" % best_acc)
+        if is_test_step:
+            # Collect the previous test before its checkpoint gets overwritten
+            if eval_job is not None:
+                best_acc = finish_evaluation(eval_job, best_acc)
             save_checkpoint({
                 'step': step + 1,
                 'model': model.state_dict(),
                 'best_acc': best_acc,
-                'optimizer' : optimizer.state_dict()
-                }, is_best, path=args.save_path, filename="checkpoint.pth")
-            
-            # Write to tfboard
-            writer.add_scalar('train/label-acc', top1.item(), step)
-            if args.mix_up:
-                writer.add_scalar('train/unlabel-acc', unlabel_top1.item(), step)
-            writer.add_scalar('train/loss', loss.item(), step)
-            writer.add_scalar('train/lr', optimizer.param_groups[0]['lr'], step)
-            writer.add_scalar('test/accuracy', val_acc, step)
+                'optimizer' : optimizer.state_dict(),
+                'scaler': scaler.state_dict()
+                }, False, path=args.save_path, filename="checkpoint.pth")
+            eval_job = start_evaluation(step)
             
             # Reset AverageMeters
             losses.reset()
             acc.reset()
             if args.mix_up:
                 unlabel_acc.reset()
+    
+    # Wait for the last test
+    if eval_job is not None:
+        best_acc = finish_evaluation(eval_job, best_acc)
+    eval_executor.shutdown()
+
+def start_evaluation(step):
+    """ Test a snapshot of the current model in a background thread """
+    eval_model.load_state_dict(model.state_dict())
+    # BN statistics are frozen during test, so fold them into the preceding convs
+    fused_model = fuse_conv_bn(copy.deepcopy(eval_model).eval())
+    eval_stream.wait_stream(torch.cuda.current_stream())
+    def _evaluate():
+        with torch.cuda.stream(eval_stream):
+            return evaluate(test_loader, fused_model)
+    return step, eval_executor.submit(_evaluate)
+
+def finish_evaluation(eval_job, best_acc):
+    """ Wait for a test started by `start_evaluation` and remember the best checkpoint """
+    step, future = eval_job
+    acc = future.result()
+    # The checkpoint of `step` is still the latest one
+    if acc > best_acc:
+        best_acc = acc
+        copy_best_checkpoint(args.save_path, filename="checkpoint.pth")
+    logger.info("Best Accuracy: %.5f" % best_acc)
+    
+    # Write to tfboard
+    writer.add_scalar('test/accuracy', acc, step)
+    return best_acc
 
 @torch.no_grad()
 def evaluate(test_loader, model):
-    batch_time, losses, acc = [AverageMeter() for _ in range(3)]
+    batch_time = AverageMeter()
+    losses, acc = [GPUMeter() for _ in range(2)]
     # switch to evaluate mode
     model.eval()
     end = time.time()
-    for i, (data, target) in enumerate(test_loader):
-        # Load data
-        data = data.cuda()
-        target = target.cuda()
-        
+    for i, (data, target) in enumerate(CUDAPrefetcher(test_loader, memory_format)):
         # Compute output
-        pred = model(data)
-        loss = F.cross_entropy(pred, target, reduction='mean')
+        with autocast(enabled=args.amp):
+            pred = model(data)
+            loss, top1 = loss_and_accuracy(pred, target)
         
         # Measure accuracy and record loss
-        top1, = accuracy(pred, target, topk=(1,))
-        losses.update(loss.item(), data.size(0))
-        acc.update(top1.item(), data.size(0))
+        losses.update(loss, data.size(0))
+        acc.update(top1, data.size(0))
         # Measure elapsed time
         batch_time.update(time.time() - end)
         end = time.time()
@@ -241,7 +322,6 @@ def evaluate(test_loader, model):
                         .format(i, len(test_loader), btime=batch_time, loss=losses, acc=acc))
     
     logger.info(' * Accuracy {acc.avg:.5f}'.format(acc=acc))
-    model.train()
     return acc.avg
 
 if __name__ == "__main__":
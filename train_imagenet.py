@@ -99,6 +99,9 @@ class HybridValPipe(Pipeline):
         return [output, self.labels]  
 
 torch.backends.cudnn.benchmark = True
+# Allow TF32 Tensor Cores for conv and matmul on Ampere and newer GPUs
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
 os.makedirs(args.tmp, exist_ok=True)
 if args.local_rank == 0:
     tfboard_writer = SummaryWriter(log_dir=args.tmp)
@@ -230,7 +233,6 @@ def train(train_loader, model, optimizer, scheduler, epoch):
             losses.update(loss.item(), image.size(0))
             acc1.update(top1.item(), image.size(0))
             acc5.update(top5.item(), image.size(0))
-        # torch.cuda.synchronize()
         
         # Log training info
         if i % args.print_freq == 0 and args.local_rank == 0:
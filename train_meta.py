@@ -1,12 +1,14 @@
-import os, argparse, torch, math, time, random
+import os, argparse, torch, math, time, random, copy
+from concurrent.futures import ThreadPoolExecutor
 from os.path import join, isfile
 import torch.nn.functional as F
 from torch.optim import SGD
+from torch.cuda.amp import autocast, GradScaler
 from torch.distributions import Beta
-from tensorboardX import SummaryWriter
+from torch.func import functional_call
 
-from dataloader import dataloader
-from utils import make_folder, AverageMeter, Logger, accuracy, save_checkpoint, compute_weight
+from dataloader import dataloader, CUDAPrefetcher
+from utils import make_folder, AverageMeter, GPUMeter, AsyncSummaryWriter, Logger, accuracy, loss_and_accuracy, fuse_conv_bn, save_checkpoint, copy_best_checkpoint, compute_weight
 from model import ConvLarge, shakeshake26, wideresnet28
 
 parser = argparse.ArgumentParser()
@@ -34,6 +36,9 @@ parser.add_argument('--milestones', type=eval, default=[300000, 350000], help='L
 parser.add_argument('--weight-decay', type=float, default=1e-4, help='Weight decay')
 parser.add_argument('--momentum', type=float, default=0.9, help='Momentum for SGD optimizer')
 parser.add_argument('--num-workers', type=int, default=4, help='Number of workers')
+parser.add_argument('--compile', action='store_true', help='Compile the model with torch.compile')
+parser.add_argument('--amp', action='store_true', help='Use automatic mixed precision (fp16) training')
+parser.add_argument('--channels-last', action='store_true', help='Use channels_last (NHWC) memory format')
 parser.add_argument('--resume', type=str, default=None, help='Resume model from a checkpoint')
 parser.add_argument('--seed', type=int, default=1234, help='Random seed for reproducibility')
 parser.add_argument('--print-freq', type=int, default=100, help='Print and log frequency')
@@ -41,6 +46,7 @@ parser.add_argument('--test-freq', type=int, default=400, help='Test frequency')
 parser.add_argument('--save-path', type=str, default='./results/tmp', help='Save path')
 args = parser.parse_args()
 args.num_classes = 100 if args.dataset == 'cifar100' else 10
+memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
 
 # Set random seed
 random.seed(args.seed)
@@ -53,10 +59,13 @@ torch.backends.cudnn.benchmark = False
 # Create directories if not exist
 make_folder(args.save_path)
 logger = Logger(join(args.save_path, 'log.txt'))
-writer = SummaryWriter(log_dir=args.save_path)
+writer = AsyncSummaryWriter(log_dir=args.save_path)
 logger.info('Called with args:')
 logger.info(args)
 torch.backends.cudnn.benchmark = True
+# Allow TF32 Tensor Cores for conv and matmul on Ampere and newer GPUs
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
 
 # Define dataloader
 logger.info("Loading data...")
@@ -71,6 +80,7 @@ train_loader, test_loader = dataloader(
         additional = args.additional,
         save_path = args.save_path
         )
+train_prefetcher = CUDAPrefetcher(train_loader, memory_format)
 
 # Build model and optimizer
 logger.info("Building model and optimizer...")
@@ -80,7 +90,22 @@ elif args.architecture == "shakeshake":
     model = shakeshake26(num_classes=args.num_classes).cuda()
 elif args.architecture == "wrn":
     model = wideresnet28(num_classes=args.num_classes).cuda()
-optimizer = SGD(model.parameters(), lr=args.lr, momentum=args.momentum, weight_decay=args.weight_decay)
+model = model.to(memory_format=memory_format)
+# Frozen replica for testing, so that training goes on while it is evaluated on a side stream
+eval_model = copy.deepcopy(model)
+eval_stream = torch.cuda.Stream()
+eval_executor = ThreadPoolExecutor(max_workers=1)
+if args.compile:
+    # Fall back to eager mode for any op TorchInductor cannot handle
+    import torch._dynamo
+    torch._dynamo.config.suppress_errors = True
+    # Compile in place so that `state_dict()` keys stay compatible with eager checkpoints
+    # No CUDA graph trees: back-to-back eval mode calls (finite differences, pseudo-labeling)
+    # would overwrite the output buffers of earlier calls that are still read afterwards
+    model.compile(mode='max-autotune-no-cudagraphs', dynamic=False)
+    loss_and_accuracy = torch.compile(loss_and_accuracy)
+optimizer = SGD(model.parameters(), lr=args.lr, momentum=args.momentum, weight_decay=args.weight_decay, fused=True)
+scaler = GradScaler(enabled=args.amp)
 logger.info("Model:\n%s\nOptimizer:\n%s" % (str(model), str(optimizer)))
 
 # Optionally build beta distribution
@@ -96,6 +121,9 @@ if args.resume is not None:
         best_acc = checkpoint['best_acc']
         model.load_state_dict(checkpoint['model'])
         optimizer.load_state_dict(checkpoint['optimizer'])
+        # A disabled scaler saves an empty state
+        if checkpoint.get('scaler'):
+            scaler.load_state_dict(checkpoint['scaler'])
         logger.info("=> loaded checkpoint '{}' (step {})".format(args.resume, checkpoint['step']))
     else:
         logger.info("=> no checkpoint found at '{}'".format(args.resume))
@@ -116,36 +144,64 @@ def compute_lr(step):
         lr = args.lr * ( 1. + math.cos( (step-args.warmup-args.const_steps) / (args.total_steps-args.warmup-args.const_steps) *  math.pi ) ) / 2.
     return lr
 
+# Learning rate of every step, computed once
+lr_table = [compute_lr(step) for step in range(args.total_steps)]
+
+def update_pseudo_gt(pseudo_gt, pred_pos, pred_neg, step_size):
+    """ Take one step along the (approximated) gradients w.r.t pseudo-gt and normalize the result """
+    # Finite difference of the consistency loss, `step_size` already divides by epsilon
+    if args.consistency == 'kl':
+        # If the consistency loss is KL Divergence
+        grad = (F.log_softmax(pred_pos, dim=1) - F.log_softmax(pred_neg, dim=1)) / 2.
+    elif args.consistency == 'mse':
+        # If the consistency loss is MSE
+        grad = F.softmax(pred_pos, dim=1) - F.softmax(pred_neg, dim=1)
+    if args.compile:
+        # Out of place for the compiled kernel
+        pseudo_gt = torch.relu(pseudo_gt - step_size * grad)
+        sums = torch.sum(pseudo_gt, dim=1, keepdim=True)
+        return pseudo_gt / torch.where(sums == 0., torch.ones_like(sums), sums)
+    # In place in eager mode to save allocations
+    pseudo_gt.sub_(step_size * grad).relu_()
+    sums = torch.sum(pseudo_gt, dim=1, keepdim=True)
+    return pseudo_gt.div_(sums.masked_fill_(sums == 0., 1.))
+
+if args.compile:
+    # Fuse softmax, update and normalization into a single kernel
+    update_pseudo_gt = torch.compile(update_pseudo_gt, fullgraph=True)
+
 def main():
     data_times, batch_times, label_losses, unlabel_losses, label_acc, unlabel_acc = [AverageMeter() for _ in range(6)]
     if args.mix_up: interp_losses = AverageMeter()
+    # Per-step losses and accuracies stay on device and are copied to host once per flush
+    stats_buf = torch.zeros(args.print_freq, 5 if args.mix_up else 4, device='cuda')
+    last_flushed = args.start_step - 1
     best_acc = 0.
+    eval_job = None
+    lr = None
     logger.info("Start training...")
     for step in range(args.start_step, args.total_steps):
         # Load data and distribute to devices
         data_start = time.time()
-        label_img, label_gt, unlabel_img, unlabel_gt = next(train_loader)
-        
-        label_img = label_img.cuda()
-        label_gt = label_gt.cuda()
-        unlabel_img = unlabel_img.cuda()
-        unlabel_gt = unlabel_gt.cuda()
+        label_img, label_gt, unlabel_img, unlabel_gt = train_prefetcher.next()
         _label_gt = F.one_hot(label_gt, num_classes=args.num_classes).float()
         data_end = time.time()
         
-        # Compute learning rate and meta learning rate
-        lr = compute_lr(step)
-        for param_group in optimizer.param_groups:
-            param_group['lr'] = lr
+        # Update learning rate (the optimizer is only touched when it changes) and meta learning rate
+        if lr_table[step] != lr:
+            lr = lr_table[step]
+            for param_group in optimizer.param_groups:
+                param_group['lr'] = lr
         weight = compute_weight(args.weight, step, args.warmup)
 
         ### First-order Approximation ###
         _concat = lambda xs: torch.cat([x.view(-1) for x in xs])
         # Evaluation mode
         model.eval()
-        # Forward label data and perform backward pass
+        # Forward label data and perform backward pass.
+        # Kept in fp32 like the finite differences below: unscaled fp16 gradients may underflow to a zero `dtheta`
         label_pred = model(label_img)
-        label_loss = F.cross_entropy(label_pred, label_gt, reduction='mean')
+        label_loss, label_top1 = loss_and_accuracy(label_pred, label_gt)
         dtheta = torch.autograd.grad(label_loss, model.parameters(), only_inputs=True)
         
         with torch.no_grad():
@@ -155,75 +211,77 @@ def main():
             # Compute step size for first-order approximation
             epsilon = args.epsilon / torch.norm(_concat(dtheta))
             
+            # Finite differences run on perturbed copies of the params, the weights themselves are never modified
+            params = dict(model.named_parameters())
             # Forward finite difference
-            for p, g in zip(model.parameters(), dtheta):
-                p.data.add_(epsilon, g)            
-            unlabel_pred_pos = model(unlabel_img)
+            unlabel_pred_pos = functional_call(model, {k: p + epsilon * g for (k, p), g in zip(params.items(), dtheta)}, (unlabel_img,))
             # Backward finite difference
-            for p, g in zip(model.parameters(), dtheta):
-                p.data.sub_(2.*epsilon, g)
-            unlabel_pred_neg = model(unlabel_img)
-            # Resume original params
-            for p, g in zip(model.parameters(), dtheta):
-                p.data.add_(epsilon, g)
-            
-            # Compute (approximated) gradients w.r.t pseudo-gt of unlabel data
-            if args.consistency == 'kl':
-                # If the consistency loss is KL Divergence
-                unlabel_grad = F.log_softmax(unlabel_pred_pos, dim=1) - F.log_softmax(unlabel_pred_neg, dim=1)
-                unlabel_grad.div_(2.*epsilon)
-            elif args.consistency == 'mse':
-                # If the consistency loss is MSE
-                unlabel_grad = F.softmax(unlabel_pred_pos, dim=1) - F.softmax(unlabel_pred_neg, dim=1)
-                unlabel_grad.div_(epsilon)
+            unlabel_pred_neg = functional_call(model, {k: p - epsilon * g for (k, p), g in zip(params.items(), dtheta)}, (unlabel_img,))
             
             # Update and normalize pseudo-labels
-            unlabel_pseudo_gt.sub_(lr, unlabel_grad)
-            torch.relu_(unlabel_pseudo_gt)
-            sums = torch.sum(unlabel_pseudo_gt, dim=1, keepdim=True)
-            unlabel_pseudo_gt /= torch.where(sums == 0., torch.ones_like(sums), sums)
+            unlabel_pseudo_gt = update_pseudo_gt(unlabel_pseudo_gt, unlabel_pred_pos, unlabel_pred_neg, lr / epsilon)
         
         # Training mode
         model.train()
-        # First compute label loss
-        if args.mix_up:
-            # Adopt mix-up augmentation
-            with torch.no_grad():
-                alpha = beta_distribution.sample((args.batch_size,)).cuda()
-                _alpha = alpha.view(-1, 1, 1, 1)
-                interp_img = (label_img * _alpha + unlabel_img * (1. - _alpha)).detach()
-                interp_pseudo_gt = (_label_gt * alpha + unlabel_pseudo_gt * (1. - alpha)).detach()
-            interp_pred = model(interp_img)
-            interp_loss = F.kl_div(F.log_softmax(interp_pred, dim=1), interp_pseudo_gt, reduction='batchmean')
-        else:
-            # Regular label loss
-            label_pred = model(label_img)
-            label_loss = F.cross_entropy(label_pred, label_gt, reduction='mean')
-            
-        # Then compute unlabel loss with `unlabel_pseudo_gt`
-        unlabel_pred = model(unlabel_img)
-        if args.consistency == 'kl':
-            unlabel_loss = F.kl_div(F.log_softmax(unlabel_pred, dim=1), unlabel_pseudo_gt, reduction='batchmean')
-        elif args.consistency == 'mse':
-            unlabel_loss = torch.norm(F.softmax(unlabel_pred, dim=1)-unlabel_pseudo_gt, p=2, dim=1).pow(2).mean()
-        loss = interp_loss + weight * unlabel_loss if args.mix_up else label_loss + weight * unlabel_loss
+        with autocast(enabled=args.amp):
+            # First compute label loss
+            if args.mix_up:
+                # Adopt mix-up augmentation
+                with torch.no_grad():
+                    alpha = beta_distribution.sample((args.batch_size,)).cuda()
+                    _alpha = alpha.view(-1, 1, 1, 1)
+                    interp_img = (label_img * _alpha + unlabel_img * (1. - _alpha)).detach()
+                    interp_pseudo_gt = (_label_gt * alpha + unlabel_pseudo_gt * (1. - alpha)).detach()
+                interp_pred = model(interp_img)
+                interp_loss = F.kl_div(F.log_softmax(interp_pred, dim=1), interp_pseudo_gt, reduction='batchmean')
+            else:
+                # Regular label loss
+                label_pred = model(label_img)
+                label_loss, label_top1 = loss_and_accuracy(label_pred, label_gt)
+                
+            # Then compute unlabel loss with `unlabel_pseudo_gt`
+            unlabel_pred = model(unlabel_img)
+            if args.consistency == 'kl':
+                unlabel_loss = F.kl_div(F.log_softmax(unlabel_pred, dim=1), unlabel_pseudo_gt, reduction='batchmean')
+            elif args.consistency == 'mse':
+                unlabel_loss = torch.norm(F.softmax(unlabel_pred, dim=1)-unlabel_pseudo_gt, p=2, dim=1).pow(2).mean()
+            loss = interp_loss + weight * unlabel_loss if args.mix_up else label_loss + weight * unlabel_loss
                 
         # One SGD step
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
         
-        # Compute accuracy
-        label_top1, = accuracy(label_pred, label_gt, topk=(1,))
+        # Compute accuracy (label accuracy comes along with the label loss)
         unlabel_top1, = accuracy(unlabel_pred, unlabel_gt, topk=(1,))
+        # Record losses and accuracies without syncing with the device
+        stats = [label_loss.detach(), unlabel_loss.detach(), label_top1, unlabel_top1]
+        if args.mix_up: stats.append(interp_loss.detach())
+        stats_buf[step % args.print_freq] = torch.cat([x.view(1) for x in stats])
         # Update AverageMeter stats
         data_times.update(data_end - data_start)
         batch_times.update(time.time() - data_end)
-        label_losses.update(label_loss.item(), label_img.size(0))
-        unlabel_losses.update(unlabel_loss.item(), unlabel_img.size(0))
-        label_acc.update(label_top1.item(), label_img.size(0))
-        unlabel_acc.update(unlabel_top1.item(), unlabel_img.size(0))
-        if args.mix_up: interp_losses.update(interp_loss.item(), label_img.size(0))
+        
+        # Flush buffered stats to AverageMeters and tfboard
+        is_test_step = (step + 1) % args.test_freq == 0 or step == args.total_steps - 1
+        if step % args.print_freq == 0 or is_test_step:
+            stats_host = stats_buf.tolist()
+            for s in range(last_flushed + 1, step + 1):
+                values = stats_host[s % args.print_freq]
+                label_losses.update(values[0], args.batch_size)
+                unlabel_losses.update(values[1], args.batch_size)
+                label_acc.update(values[2], args.batch_size)
+                unlabel_acc.update(values[3], args.batch_size)
+                writer.add_scalar('train/label-loss', values[0], s)
+                writer.add_scalar('train/unlabel-loss', values[1], s)
+                writer.add_scalar('train/label-acc', values[2], s)
+                writer.add_scalar('train/unlabel-acc', values[3], s)
+                if args.mix_up:
+                    interp_losses.update(values[4], args.batch_size)
+                    writer.add_scalar('train/interp-loss', values[4], s)
+                writer.add_scalar('train/lr', lr_table[s], s)
+            last_flushed = step
         
         # Print and log
         if step % args.print_freq == 0:
@@ -234,29 +292,18 @@ def main():
                                              ulosses=unlabel_losses, label=label_acc, unlabel=unlabel_acc))
         
         # Test and save model
-        if (step + 1) % args.test_freq == 0 or step == args.total_steps - 1:
-            acc = evaluate(test_loader, model)
-            
-            # Remember best accuracy and save checkpoint
-            is_best = acc > best_acc
-            if is_best:
-                best_acc = acc
-            logger.info("Best Accuracy: %.5f" % best_acc)
+        if is_test_step:
+            # Collect the previous test before its checkpoint gets overwritten
+            if eval_job is not None:
+                best_acc = finish_evaluation(eval_job, best_acc)
             save_checkpoint({
                 'step': step + 1,
                 'model': model.state_dict(),
                 'best_acc': best_acc,
-                'optimizer' : optimizer.state_dict()
-                }, is_best, path=args.save_path, filename="checkpoint.pth")
-            
-            # Write to the tfboard
-            writer.add_scalar('train/label-acc', label_acc.avg, step)
-            writer.add_scalar('train/unlabel-acc', unlabel_acc.avg, step)
-            writer.add_scalar('train/label-loss', label_losses.avg, step)
-            writer.add_scalar('train/unlabel-loss', unlabel_losses.avg, step)
-            writer.add_scalar('train/lr', lr, step)
-            writer.add_scalar('test/accuracy', acc, step)
-            if args.mix_up: writer.add_scalar('train/interp-loss', interp_losses.avg, step)
+                'optimizer' : optimizer.state_dict(),
+                'scaler': scaler.state_dict()
+                }, False, path=args.save_path, filename="checkpoint.pth")
+            eval_job = start_evaluation(step)
             
             # Reset AverageMeters
             label_losses.reset()
@@ -264,26 +311,53 @@ def main():
             label_acc.reset()
             unlabel_acc.reset()
             if args.mix_up: interp_losses.reset()
+    
+    # Wait for the last test
+    if eval_job is not None:
+        best_acc = finish_evaluation(eval_job, best_acc)
+    eval_executor.shutdown()
+
+def start_evaluation(step):
+    """ Test a snapshot of the current model in a background thread """
+    eval_model.load_state_dict(model.state_dict())
+    # BN statistics are frozen during test, so fold them into the preceding convs
+    fused_model = fuse_conv_bn(copy.deepcopy(eval_model).eval())
+    eval_stream.wait_stream(torch.cuda.current_stream())
+    def _evaluate():
+        with torch.cuda.stream(eval_stream):
+            return evaluate(test_loader, fused_model)
+    return step, eval_executor.submit(_evaluate)
+
+def finish_evaluation(eval_job, best_acc):
+    """ Wait for a test started by `start_evaluation` and remember the best checkpoint """
+    step, future = eval_job
+    acc = future.result()
+    # The checkpoint of `step` is still the latest one
+    if acc > best_acc:
+        best_acc = acc
+        copy_best_checkpoint(args.save_path, filename="checkpoint.pth")
+    logger.info("Best Accuracy: %.5f" % best_acc)
+    
+    # Write to tfboard
+    writer.add_scalar('test/accuracy', acc, step)
+    return best_acc
 
 @torch.no_grad()
 def evaluate(test_loader, model):
-    batch_time, losses, acc = [AverageMeter() for _ in range(3)]
+    batch_time = AverageMeter()
+    losses, acc = [GPUMeter() for _ in range(2)]
     # switch to evaluate mode
     model.eval()
     end = time.time()
-    for i, (data, target) in enumerate(test_loader):
-        # Load data
-        data = data.cuda()
-        target = target.cuda()
-        
+    for i, (data, target) in enumerate(CUDAPrefetcher(test_loader, memory_format)):
         # Compute output
-        pred = model(data)
-        loss = F.cross_entropy(pred, target, reduction='mean')
+        with autocast(enabled=args.amp):
+            pred = model(data)
+            loss, top1 = loss_and_accuracy(pred, target)
         
         # Measure accuracy and record loss
-        top1, = accuracy(pred, target, topk=(1,))
-        losses.update(loss.item(), data.size(0))
-        acc.update(top1.item(), data.size(0))
+        losses.update(loss, data.size(0))
+        acc.update(top1, data.size(0))
         # Measure elapsed time
         batch_time.update(time.time() - end)
         end = time.time()
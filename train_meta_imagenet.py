@@ -11,8 +11,9 @@ from nvidia.dali.plugin.pytorch import DALIClassificationIterator
 # distributed
 import torch.nn.functional as F
 from torch.distributions import Beta
+from torch.func import functional_call
 import torch.distributed as dist
-from apex.parallel import DistributedDataParallel as DDP
+from torch.nn.parallel import DistributedDataParallel as DDP
 warnings.filterwarnings("ignore", "(Possibly )?corrupt EXIF data", UserWarning)
 warnings.simplefilter('error')
 
@@ -37,7 +38,7 @@ parser.add_argument('--epsilon', type=float, default=1e-2, help='epsilon for gra
 parser.add_argument('--resume', default=None, type=str, metavar='PATH', help='path to the latest checkpoint')
 parser.add_argument('--tmp', default="results/tmp", type=str, help='tmp folder')
 # distributed
-parser.add_argument("--local_rank", default=0, type=int)
+parser.add_argument("--local_rank", "--local-rank", default=int(os.environ.get('LOCAL_RANK', 0)), type=int)
 parser.add_argument('--dali-cpu', action='store_true', help='Runs CPU based version of DALI pipeline.')
 args = parser.parse_args()
 
@@ -108,6 +109,9 @@ class HybridValPipe(Pipeline):
         return [output, self.labels]  
 
 torch.backends.cudnn.benchmark = True
+# Allow TF32 Tensor Cores for conv and matmul on Ampere and newer GPUs
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
 os.makedirs(args.tmp, exist_ok=True)
 if args.local_rank == 0:
     tfboard_writer = SummaryWriter(log_dir=args.tmp)
@@ -152,7 +156,7 @@ def main():
     if args.local_rank == 0:
         logger.info("Model details:")
         logger.info(model)
-    model = DDP(model, delay_allreduce=False)
+    model = DDP(model, device_ids=[args.gpu], gradient_as_bucket_view=True)
     optimizer = torch.optim.SGD(model.parameters(), lr=args.lr, momentum=args.momentum, weight_decay=args.wd)
     if args.local_rank == 0:
         logger.info("Optimizer details:")
@@ -209,6 +213,9 @@ def train(label_provider, unlabel_loader, model, optimizer, scheduler, epoch):
                 [AverageMeter() for _ in range(8)]
         unlabel_loader_len = int(np.ceil(unlabel_loader._size/args.batch_size))
     
+    # The first-order approximation runs on the local replica: its gradients are taken with
+    # `torch.autograd.grad`, which never fires the DDP allreduce hooks
+    net = model.module
     # Switch to train mode
     model.train()
     if args.local_rank == 0:
@@ -232,30 +239,25 @@ def train(label_provider, unlabel_loader, model, optimizer, scheduler, epoch):
         ### First-order Approximation ###
         _concat = lambda xs: torch.cat([x.view(-1) for x in xs])
         # Evaluation mode
-        model.eval()
+        net.eval()
         # Forward label data and perform backward pass
-        label_pred = model(label_img)
+        label_pred = net(label_img)
         label_loss = F.cross_entropy(label_pred, label_gt, reduction='mean')
-        dtheta = torch.autograd.grad(label_loss, model.parameters(), only_inputs=True)
+        dtheta = torch.autograd.grad(label_loss, net.parameters(), only_inputs=True)
 
         with torch.no_grad():
             # Compute the unlabel pseudo-gt
-            unlabel_pred = model(unlabel_img)
+            unlabel_pred = net(unlabel_img)
             unlabel_pseudo_gt = F.softmax(unlabel_pred, dim=1)
             # Compute step size for first-order approximation
             epsilon = args.epsilon / torch.norm(_concat(dtheta))
             
+            # Finite differences run on perturbed copies of the params, the weights themselves are never modified
+            params = dict(net.named_parameters())
             # Forward finite difference
-            for p, g in zip(model.parameters(), dtheta):
-                p.data.add_(epsilon, g)            
-            unlabel_pred_pos = model(unlabel_img)
+            unlabel_pred_pos = functional_call(net, {k: p + epsilon * g for (k, p), g in zip(params.items(), dtheta)}, (unlabel_img,))
             # Backward finite difference
-            for p, g in zip(model.parameters(), dtheta):
-                p.data.sub_(2.*epsilon, g)
-            unlabel_pred_neg = model(unlabel_img)
-            # Resume original params
-            for p, g in zip(model.parameters(), dtheta):
-                p.data.add_(epsilon, g)
+            unlabel_pred_neg = functional_call(net, {k: p - epsilon * g for (k, p), g in zip(params.items(), dtheta)}, (unlabel_img,))
 
             # Compute (approximated) gradients w.r.t pseudo-gt of unlabel data
             unlabel_grad = F.softmax(unlabel_pred_pos, dim=1) - F.softmax(unlabel_pred_neg, dim=1)
@@ -311,7 +313,6 @@ def train(label_provider, unlabel_loader, model, optimizer, scheduler, epoch):
             label_acc5.update(label_top5.item(), label_img.size(0))
             unlabel_acc1.update(unlabel_top1.item(), unlabel_img.size(0))
             unlabel_acc5.update(unlabel_top5.item(), unlabel_img.size(0))
-        # torch.cuda.synchronize()
         
         # Log training info
         if i % args.print_freq == 0 and args.local_rank == 0:
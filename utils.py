@@ -1,4 +1,7 @@
-import os, logging, shutil, torch, math
+import os, logging, logging.handlers, shutil, torch, math, queue, threading
+import torch.nn.functional as F
+from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 from os.path import exists, join
 
 def make_folder(path):
@@ -9,23 +12,55 @@ def compute_weight(weight, step, rampup_step=4000):
     return weight if step > rampup_step else weight * step / rampup_step
 
 class Logger():
+    """ Records are only enqueued by the caller, formatting and I/O happen on a listener thread """
     def __init__(self, path="log.txt"):
         self.logger = logging.getLogger("Logger")
         self.file_handler = logging.FileHandler(path, "w")
         self.stdout_handler = logging.StreamHandler()
-        self.logger.addHandler(self.file_handler)
-        self.logger.addHandler(self.stdout_handler)
         self.stdout_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
         self.file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+        self.queue = queue.Queue(-1)
+        self.queue_handler = logging.handlers.QueueHandler(self.queue)
+        self.logger.addHandler(self.queue_handler)
         self.logger.setLevel(logging.INFO)
+        self.listener = logging.handlers.QueueListener(self.queue, self.file_handler, self.stdout_handler)
+        self.listener.start()
     
     def info(self, txt):
         self.logger.info(txt)
     
     def close(self):
+        # drains the queue before the handlers are closed
+        self.listener.stop()
+        self.logger.removeHandler(self.queue_handler)
         self.file_handler.close()
         self.stdout_handler.close()
 
+class AsyncSummaryWriter():
+    """ Write tensorboard scalars from a background thread """
+    def __init__(self, log_dir, flush_secs=60, max_queue=1000):
+        # Imported here so that scripts on tensorboardX do not need the tensorboard package
+        from torch.utils.tensorboard import SummaryWriter
+        self.writer = SummaryWriter(log_dir=log_dir, flush_secs=flush_secs, max_queue=max_queue)
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+    
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            self.writer.add_scalar(*item)
+    
+    def add_scalar(self, tag, value, step):
+        self.queue.put((tag, value, step))
+    
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.writer.close()
+
 class AverageMeter(object):
     """Computes and stores the average and current value"""
     def __init__(self):
@@ -43,10 +78,44 @@ class AverageMeter(object):
         self.count += n
         self.avg = self.sum / self.count
 
+class GPUMeter(object):
+    """Computes and stores the average and current value of device tensors without syncing on update"""
+    def __init__(self, device='cuda'):
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        self.val = torch.zeros((), device=self.device)
+        self.sum = torch.zeros((), device=self.device)
+        self.count = 0
+
+    def update(self, val, n=1):
+        self.val = val.detach().reshape(())
+        self.sum += self.val * n
+        self.count += n
+
+    @property
+    def avg(self):
+        return (self.sum / self.count).item()
+
+def fuse_conv_bn(module):
+    """Folds every BatchNorm2d that directly follows a Conv2d inside an nn.Sequential into the conv (eval mode only)"""
+    for child in module.children():
+        if isinstance(child, nn.Sequential):
+            for i in range(len(child) - 1):
+                if isinstance(child[i], nn.Conv2d) and isinstance(child[i + 1], nn.BatchNorm2d):
+                    child[i] = fuse_conv_bn_eval(child[i], child[i + 1])
+                    child[i + 1] = nn.Identity()
+        fuse_conv_bn(child)
+    return module
+
 def save_checkpoint(state, is_best, path, filename="checkpoint.pth"):
     torch.save(state, join(path, filename))
     if is_best:
-        shutil.copyfile(join(path, filename), join(path, 'model_best.pth'))
+        copy_best_checkpoint(path, filename)
+
+def copy_best_checkpoint(path, filename="checkpoint.pth"):
+    shutil.copyfile(join(path, filename), join(path, 'model_best.pth'))
 
 def accuracy(output, target, topk=(1,)):
     """Computes the precision@k for the specified values of k"""
@@ -64,6 +133,12 @@ def accuracy(output, target, topk=(1,)):
             res.append(correct_k.mul_(100.0 / batch_size))
         return res
 
+def loss_and_accuracy(output, target):
+    """Computes the cross-entropy loss and the top-1 precision from one pass over the logits"""
+    loss = F.cross_entropy(output, target, reduction='mean')
+    top1 = output.argmax(dim=1).eq(target).float().mean().mul(100.)
+    return loss, top1.detach()
+
 class CosAnnealingLR(object):
     def __init__(self, loader_len, epochs, lr_max, warmup_epochs=0, last_epoch=-1):
         max_iters = loader_len * epochs